@@ -6,6 +6,14 @@ import time
 import json
 import math
 import threading
+import base64
+import hashlib
+import zlib
+import cProfile
+import pstats
+import os
+import sys
+from collections import Counter, deque
 
 BROKER = "broker.hivemq.com"
 PORT = 1883
@@ -13,239 +21,975 @@ TOPIC_CMD = "datacenter/fuzzy/cmd"
 TOPIC_RES = "datacenter/fuzzy/result"
 TOPIC_STREAM = "datacenter/fuzzy/stream"
 TOPIC_ALERT = "datacenter/fuzzy/alert"
+TOPIC_KPI = "datacenter/fuzzy/kpi"
+TOPIC_ARTEFATO = "datacenter/fuzzy/artefato"  # retido: curvas MF + superfície
+
+PASSOS_DIA = 1440  # 24 h em minutos
+MAX_HORIZONTE = 7 * PASSOS_DIA  # limite de "horizonte_min" por simulação
+
+# limites operacionais para alerta
+LIM_INF = 18
+LIM_SUP = 26
+
+# KPIs de controle publicados durante a simulação
+BANDA_FAIXA = 2.0        # tempo em faixa: |erro| <= 2 °C
+BANDA_ACOMODACAO = 0.5   # acomodado: |erro| <= 0.5 °C
+KPI_INTERVALO = 15       # passos entre publicações em TOPIC_KPI
+JANELAS_KPI = (
+    ("15min", "deslizante", 15),
+    ("1h", "fixa", 60),
+    ("acumulado", "acumulada", None),
+)
 
 simulating = False
+parada_solicitada = False  # comando "parar_simulacao"
+
+# Definição do sistema fuzzy como dados, para poder ser substituída em tempo
+# de execução (comando "atualizar_fuzzy"). Cada termo é [tipo, parâmetros].
+DEFINICAO_PADRAO = {
+    "erro": {
+        "universo": [-12, 12.1, 0.1],
+        "termos": {
+            "MN": ["trapmf", [-12, -12, -6, -3.5]],
+            "PN": ["trimf", [-6, -3.5, 0]],
+            "ZE": ["trimf", [-3.5, 0, 3.5]],
+            "PP": ["trimf", [0, 3.5, 6]],
+            "MP": ["trapmf", [3.5, 6, 12, 12]],
+        }
+    },
+    "delta_erro": {
+        "universo": [-6, 6.01, 0.01],
+        "termos": {
+            "MN": ["trapmf", [-6, -6, -2, -1]],
+            "PN": ["trimf", [-2, -1, 0]],
+            "ZE": ["trimf", [-1, 0, 1]],
+            "PP": ["trimf", [0, 1, 2]],
+            "MP": ["trapmf", [1, 2, 6, 6]],
+        }
+    },
+    "p_crac": {
+        "universo": [0, 101, 1],
+        "termos": {
+            "MB": ["trimf", [0, 0, 25]],
+            "B": ["trimf", [0, 25, 50]],
+            "M": ["trimf", [25, 50, 75]],
+            "A": ["trimf", [50, 75, 100]],
+            "MA": ["trimf", [75, 100, 100]],
+        }
+    },
+    # Base de regras: uma linha por termo de 'erro', uma coluna por termo de
+    # 'delta_erro' (na ordem em que foram definidos), valor = termo de 'p_crac'
+    "regras": {
+        "MN": ["MB", "MB", "MB", "B", "M"],    # Muito Frio -> Resfriamento Mínimo
+        "PN": ["MB", "B", "M", "M", "A"],      # Pouco Frio -> Baixo / Médio
+        "ZE": ["MB", "B", "B", "A", "MA"],     # Zero Erro -> Médio (estável em B)
+        "PP": ["B", "M", "A", "MA", "MA"],     # Pouco Quente -> Alto / Máximo
+        "MP": ["M", "A", "MA", "MA", "MA"],    # Muito Quente -> Máximo
+    }
+}
+
+# tipo -> (função do skfuzzy, número de parâmetros)
+FUNCOES_PERTINENCIA = {
+    "trimf": (fuzz.trimf, 3),
+    "trapmf": (fuzz.trapmf, 4),
+}
+
+VARIAVEIS = ("erro", "delta_erro", "p_crac")
+MAX_VERSOES = 10  # versões anteriores guardadas para rollback
+MAX_PONTOS_UNIVERSO = 10001  # pontos de np.arange por universo
+
+GRADE_SUPERFICIE = (49, 61)  # pontos (erro, delta_erro) da superfície pré-calculada
+
+# Comando "controle_lote"
+MAX_LOTE = 20000   # pontos por comando
+BLOCO_LOTE = 1024  # pontos por passada vetorizada (limita a memória temporária)
+
+# Profiling sob demanda (comando "perfilar")
+PERFIL_DIR = "perfis"
+PERFIL_TOP = 15                  # funções no resumo publicado
+PERFIL_INTERVALO_AMOSTRA = 0.005 # segundos entre amostras no modo "amostragem"
+
+def validar_definicao(definicao):
+    """Levanta ValueError se a definição não puder ser compilada."""
+    for nome in VARIAVEIS:
+        var = definicao.get(nome)
+        if not isinstance(var, dict):
+            raise ValueError(f"Variável '{nome}' ausente")
+
+        universo = var.get("universo")
+        if not isinstance(universo, list) or len(universo) != 3:
+            raise ValueError(f"Universo de '{nome}' deve ser [início, fim, passo]")
+        inicio, fim, passo = (float(v) for v in universo)
+        if not all(math.isfinite(v) for v in (inicio, fim, passo)) or passo <= 0 or fim <= inicio:
+            raise ValueError(f"Universo de '{nome}' inválido: {universo}")
+        if (fim - inicio) / passo >= MAX_PONTOS_UNIVERSO:
+            raise ValueError(f"Universo de '{nome}' excede {MAX_PONTOS_UNIVERSO} pontos: {universo}")
+
+        termos = var.get("termos")
+        if not isinstance(termos, dict) or not termos:
+            raise ValueError(f"Variável '{nome}' sem termos")
+        for termo, mf in termos.items():
+            if not isinstance(mf, list) or len(mf) != 2 or mf[0] not in FUNCOES_PERTINENCIA:
+                raise ValueError(f"Termo '{nome}.{termo}' deve ser [tipo, parâmetros]")
+            tipo, params = mf
+            n_params = FUNCOES_PERTINENCIA[tipo][1]
+            if not isinstance(params, list) or len(params) != n_params:
+                raise ValueError(f"Termo '{nome}.{termo}' ({tipo}) precisa de {n_params} parâmetros")
+            if any(a > b for a, b in zip(params, params[1:])):
+                raise ValueError(f"Parâmetros de '{nome}.{termo}' fora de ordem: {params}")
+            if params[0] < inicio or params[-1] > fim:
+                raise ValueError(f"Parâmetros de '{nome}.{termo}' fora do universo: {params}")
+
+    regras = definicao.get("regras")
+    termos_erro = definicao["erro"]["termos"]
+    termos_delta = definicao["delta_erro"]["termos"]
+    termos_saida = definicao["p_crac"]["termos"]
+    if not isinstance(regras, dict) or list(regras) != list(termos_erro):
+        raise ValueError("A base de regras deve ter uma linha por termo de 'erro', na mesma ordem")
+    for termo_erro, linha in regras.items():
+        if not isinstance(linha, list) or len(linha) != len(termos_delta):
+            raise ValueError(f"Linha '{termo_erro}' deve ter {len(termos_delta)} saídas")
+        for saida in linha:
+            if saida not in termos_saida:
+                raise ValueError(f"Termo de saída desconhecido: '{saida}'")
+
+def compilar_sistema(definicao, versao):
+    """Valida a definição e monta um sistema fuzzy pronto para uso."""
+    validar_definicao(definicao)
+
+    variaveis = {}
+    for nome, classe in (("erro", ctrl.Antecedent),
+                         ("delta_erro", ctrl.Antecedent),
+                         ("p_crac", ctrl.Consequent)):
+        var = classe(np.arange(*definicao[nome]["universo"]), nome)
+        for termo, (tipo, params) in definicao[nome]["termos"].items():
+            var[termo] = FUNCOES_PERTINENCIA[tipo][0](var.universe, params)
+            if not var[termo].mf.any():
+                raise ValueError(f"Termo '{nome}.{termo}' é nulo em todo o universo")
+        variaveis[nome] = var
+
+    erro = variaveis["erro"]
+    delta_erro = variaveis["delta_erro"]
+    p_crac = variaveis["p_crac"]
+
+    rules = [
+        ctrl.Rule(erro[termo_erro] & delta_erro[termo_delta], p_crac[saida])
+        for termo_erro, linha in definicao["regras"].items()
+        for termo_delta, saida in zip(definicao["delta_erro"]["termos"], linha)
+    ]
+
+    crac_ctrl = ctrl.ControlSystem(rules)
+
+    sis = {
+        "versao": versao,
+        "definicao": definicao,
+        "erro": erro,
+        "delta_erro": delta_erro,
+        "p_crac": p_crac,
+        "rules": rules,
+        "crac_ctrl": crac_ctrl,
+        "tabelas": compilar_tabelas(definicao, variaveis),
+    }
+    verificar_motor(sis)
+    sis["artefato"] = gerar_artefato(sis)
+    return sis
+
+def compilar_tabelas(definicao, variaveis):
+    """Pré-calcula os arrays usados por `inferir` (uma linha de MF por termo)."""
+    tabelas = {}
+    for nome, var in variaveis.items():
+        tabelas[nome] = {
+            "universo": var.universe,
+            "termos": list(definicao[nome]["termos"]),
+            "mfs": np.array([var[termo].mf for termo in definicao[nome]["termos"]], dtype=float),
+        }
+
+    # regras[i, j] = índice do termo de saída para (erro i, delta_erro j)
+    termos_saida = tabelas["p_crac"]["termos"]
+    regras = np.array([[termos_saida.index(saida) for saida in definicao["regras"][termo_erro]]
+                       for termo_erro in definicao["erro"]["termos"]])
+    # mascara[k] marca as regras cuja saída é o termo k
+    tabelas["mascara_saida"] = np.stack([(regras == k).ravel() for k in range(len(termos_saida))])
+    tabelas["regras"] = regras
+    return tabelas
+
+def verificar_motor(sis, n=5, tolerancia=1e-6):
+    """Confere `inferir` contra `ControlSystemSimulation` numa grade n x n.
+
+    Roda a cada compilação: uma divergência (p.ex. regras indexadas na ordem
+    errada) rejeita a definição em vez de publicar saídas silenciosamente erradas.
+    """
+    sim = ctrl.ControlSystemSimulation(sis["crac_ctrl"])
+    for e in np.linspace(sis["erro"].universe[0], sis["erro"].universe[-1], n):
+        for de in np.linspace(sis["delta_erro"].universe[0], sis["delta_erro"].universe[-1], n):
+            sim.input["erro"] = e
+            sim.input["delta_erro"] = de
+            try:
+                sim.compute()
+            except ValueError:
+                continue  # nenhuma regra dispara: o skfuzzy não tem saída para comparar
+            esperado = sim.output["p_crac"]
+            obtido = inferir(sis, e, de)["p_crac"]
+            if abs(obtido - esperado) > tolerancia:
+                raise ValueError(f"Motor de inferência diverge do skfuzzy em "
+                                 f"erro={e:.3f}, delta_erro={de:.3f}: {obtido} != {esperado}")
+
+def _pertinencias(tabela, x):
+    """Graus de pertinência [N, termos] para entradas x [N] (saturadas no universo)."""
+    universo = tabela["universo"]
+    x = np.clip(x, universo[0], universo[-1])
+    return np.stack([np.interp(x, universo, mf) for mf in tabela["mfs"]], axis=-1)
+
+def _pontos_de_corte(universo, mfs, cortes):
+    """Pontos do universo onde cada MF de saída cruza o seu nível de corte.
+
+    Mesmo critério do skfuzzy ao reamostrar o universo antes da defuzzificação,
+    para que o centroide coincida com o de `ControlSystemSimulation`.
+    """
+    c = cortes[:, :, None]
+    acima = np.where(c == 0, mfs[None] > c, mfs[None] >= c)
+    cruza = acima[:, :, 1:] != acima[:, :, :-1]
+
+    y1, y2 = mfs[None, :, :-1], mfs[None, :, 1:]
+    dy = np.where(cruza, y2 - y1, 1.0)
+    x = universo[:-1] + (c - y1) * np.diff(universo) / dy
+    # pontos sem cruzamento viram duplicatas do fim do universo (largura zero)
+    return np.where(cruza, x, universo[-1]).reshape(len(cortes), -1)
+
+def _centroide(x, y):
+    """Centroide de funções lineares por partes, uma por linha de x/y."""
+    dx = np.diff(x, axis=-1)
+    x1, y1, y2 = x[:, :-1], y[:, :-1], y[:, 1:]
+    area = 0.5 * dx * (y1 + y2)
+    momento = dx * (x1 * (y1 + y2) / 2 + dx * (y1 + 2 * y2) / 6)
+    area_total = area.sum(axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(area_total > 0, momento.sum(axis=-1) / area_total, np.nan)
+
+def inferir_arrays(sis, e, de):
+    """Inferência Mamdani (min/max, centroide) em uma única passada para arrays.
+
+    Retorna pertinências, ativações das regras [N, erro, delta_erro], nível de
+    corte de cada termo de saída, conjunto agregado no universo de saída e a
+    saída defuzzificada (NaN quando nenhuma regra dispara).
+    """
+    tab = sis["tabelas"]
+    mu_e = _pertinencias(tab["erro"], np.asarray(e, dtype=float))
+    mu_de = _pertinencias(tab["delta_erro"], np.asarray(de, dtype=float))
+    n = len(mu_e)
+
+    ativacoes = np.minimum(mu_e[:, :, None], mu_de[:, None, :])
+    cortes = np.where(tab["mascara_saida"][None], ativacoes.reshape(n, 1, -1), 0.0).max(axis=-1)
+
+    universo = tab["p_crac"]["universo"].astype(float)
+    mfs = tab["p_crac"]["mfs"]
+    agregado = np.minimum(cortes[:, :, None], mfs[None]).max(axis=1)
+
+    # universo reamostrado nos pontos de corte, como faz o skfuzzy
+    x = np.sort(np.concatenate([np.broadcast_to(universo, (n, len(universo))),
+                                _pontos_de_corte(universo, mfs, cortes)], axis=1), axis=1)
+    y = np.minimum(cortes[:, :, None],
+                   np.stack([np.interp(x, universo, mf) for mf in mfs], axis=1)).max(axis=1)
+
+    return {
+        "mu_erro": mu_e,
+        "mu_delta": mu_de,
+        "ativacoes": ativacoes,
+        "cortes": cortes,
+        "agregado": agregado,
+        "saida": _centroide(x, y),
+    }
+
+def inferir(sis, e, de, explicar=False):
+    """Calcula p_crac para um par (erro, delta_erro) em uma única passada.
+
+    Com `explicar=True` inclui pertinências, ativação de cada regra e o
+    conjunto agregado, obtidos do mesmo cálculo (sem custo extra de inferência).
+    """
+    r = inferir_arrays(sis, [e], [de])
+    saida = r["saida"][0]
+    res = {"p_crac": 50.0 if np.isnan(saida) else float(saida)}
+    if explicar:
+        res.update(explicacao(sis, r, 0))
+    return res
+
+def inferir_lote(sis, e, de):
+    """Inferência vetorizada para arrays de entradas, processada em blocos."""
+    e = np.asarray(e, dtype=float).ravel()
+    de = np.asarray(de, dtype=float).ravel()
+    saida = np.concatenate([inferir_arrays(sis, e[i:i + BLOCO_LOTE], de[i:i + BLOCO_LOTE])["saida"]
+                            for i in range(0, len(e), BLOCO_LOTE)])
+    return np.where(np.isnan(saida), 50.0, saida)
+
+def explicacao(sis, r, i):
+    """Campos de explicação da i-ésima entrada de um resultado de inferir_arrays."""
+    tab = sis["tabelas"]
+    termos_erro = tab["erro"]["termos"]
+    termos_delta = tab["delta_erro"]["termos"]
+    termos_saida = tab["p_crac"]["termos"]
+
+    rules = []
+    for a, termo_erro in enumerate(termos_erro):
+        for b, termo_delta in enumerate(termos_delta):
+            rules.append({
+                "rule_id": len(rules) + 1,
+                "erro": termo_erro,
+                "delta": termo_delta,
+                "activ": round(float(r["ativacoes"][i, a, b]), 4),
+                "saida": termos_saida[tab["regras"][a, b]]
+            })
+
+    return {
+        "pertinencias": {
+            "erro": dict(zip(termos_erro, r["mu_erro"][i].round(4).tolist())),
+            "delta_erro": dict(zip(termos_delta, r["mu_delta"][i].round(4).tolist())),
+        },
+        "rules": rules,
+        "agregado": r["agregado"][i].round(4).tolist(),
+    }
+
+def gerar_artefato(sis):
+    """Curvas MF e superfície p_crac(erro, delta_erro) prontas para o frontend.
+
+    O conteúdo vai comprimido (zlib + base64) e o `etag` muda sempre que o
+    conteúdo muda, para que os clientes só decodifiquem versões novas.
+    """
+    tab = sis["tabelas"]
+    mfs = {
+        nome: {
+            "universo": tab[nome]["universo"].round(4).tolist(),
+            "termos": dict(zip(tab[nome]["termos"], tab[nome]["mfs"].round(4).tolist()))
+        }
+        for nome in VARIAVEIS
+    }
+
+    eixos = [np.linspace(tab[nome]["universo"][0], tab[nome]["universo"][-1], n)
+             for nome, n in zip(("erro", "delta_erro"), GRADE_SUPERFICIE)]
+    e, de = np.meshgrid(*eixos, indexing="ij")
+    superficie = {
+        "erro": eixos[0].round(4).tolist(),
+        "delta_erro": eixos[1].round(4).tolist(),
+        "p_crac": inferir_lote(sis, e, de).reshape(e.shape).round(3).tolist()
+    }
+
+    dados = zlib.compress(json.dumps({"mfs": mfs, "superficie": superficie}).encode(), 9)
+    return {
+        "versao": sis["versao"],
+        "etag": hashlib.sha256(dados).hexdigest()[:16],
+        "codificacao": "zlib+base64",
+        "dados": base64.b64encode(dados).decode()
+    }
+
+def publicar_artefato():
+    client.publish(TOPIC_ARTEFATO, json.dumps(sistema["artefato"]), qos=1, retain=True)
 
 print("A configurar Sistema Fuzzy...")
 
-erro = ctrl.Antecedent(np.arange(-12, 12.1, 0.1), 'erro')
-delta_erro = ctrl.Antecedent(np.arange(-6, 6.01, 0.01), 'delta_erro')
-p_crac = ctrl.Consequent(np.arange(0, 101, 1), 'p_crac')
-
-erro['MN'] = fuzz.trapmf(erro.universe, [-12, -12, -6, -3.5])
-erro['PN'] = fuzz.trimf(erro.universe, [-6, -3.5, 0])
-erro['ZE'] = fuzz.trimf(erro.universe, [-3.5, 0, 3.5])
-erro['PP'] = fuzz.trimf(erro.universe, [0, 3.5, 6])
-erro['MP'] = fuzz.trapmf(erro.universe, [3.5, 6, 12, 12])
-
-delta_erro['MN'] = fuzz.trapmf(delta_erro.universe, [-6, -6, -2, -1])
-delta_erro['PN'] = fuzz.trimf(delta_erro.universe, [-2, -1, 0])
-delta_erro['ZE'] = fuzz.trimf(delta_erro.universe, [-1, 0, 1])
-delta_erro['PP'] = fuzz.trimf(delta_erro.universe, [0, 1, 2])
-delta_erro['MP'] = fuzz.trapmf(delta_erro.universe, [1, 2, 6, 6])
-
-p_crac['MB'] = fuzz.trimf(p_crac.universe, [0, 0, 25])
-p_crac['B'] = fuzz.trimf(p_crac.universe, [0, 25, 50])
-p_crac['M'] = fuzz.trimf(p_crac.universe, [25, 50, 75])
-p_crac['A'] = fuzz.trimf(p_crac.universe, [50, 75, 100])
-p_crac['MA'] = fuzz.trimf(p_crac.universe, [75, 100, 100])
-
-# sistema_fuzzy.py (Trecho do bloco rules)
-
-rules = [
-    # --- LINHA ERRO 'MN' (Muito Frio) -> Resfriamento Mínimo (MB) ---
-    ctrl.Rule(erro['MN'] & delta_erro['MN'], p_crac['MB']),
-    ctrl.Rule(erro['MN'] & delta_erro['PN'], p_crac['MB']),
-    ctrl.Rule(erro['MN'] & delta_erro['ZE'], p_crac['MB']),
-    ctrl.Rule(erro['MN'] & delta_erro['PP'], p_crac['B']),
-    ctrl.Rule(erro['MN'] & delta_erro['MP'], p_crac['M']),
-
-    # --- LINHA ERRO 'PN' (Pouco Frio) -> Resfriamento Baixo (B) / Médio (M) ---
-    ctrl.Rule(erro['PN'] & delta_erro['MN'], p_crac['MB']),
-    ctrl.Rule(erro['PN'] & delta_erro['PN'], p_crac['B']),
-    ctrl.Rule(erro['PN'] & delta_erro['ZE'], p_crac['M']), 
-    ctrl.Rule(erro['PN'] & delta_erro['PP'], p_crac['M']),
-    ctrl.Rule(erro['PN'] & delta_erro['MP'], p_crac['A']),
-
-    # --- LINHA ERRO 'ZE' (Zero Erro) -> Resfriamento Médio (M) ---
-    ctrl.Rule(erro['ZE'] & delta_erro['MN'], p_crac['MB']), # Reduz se o erro está caindo
-    ctrl.Rule(erro['ZE'] & delta_erro['PN'], p_crac['B']),
-    ctrl.Rule(erro['ZE'] & delta_erro['ZE'], p_crac['B']), # Estabilidade no 50%
-    ctrl.Rule(erro['ZE'] & delta_erro['PP'], p_crac['A']),
-    ctrl.Rule(erro['ZE'] & delta_erro['MP'], p_crac['MA']), # Aumenta se o erro está subindo
-
-    # --- LINHA ERRO 'PP' (Pouco Quente) -> Resfriamento Alto (A) / Máximo (MA) ---
-    ctrl.Rule(erro['PP'] & delta_erro['MN'], p_crac['B']),
-    ctrl.Rule(erro['PP'] & delta_erro['PN'], p_crac['M']),
-    ctrl.Rule(erro['PP'] & delta_erro['ZE'], p_crac['A']),
-    ctrl.Rule(erro['PP'] & delta_erro['PP'], p_crac['MA']),
-    ctrl.Rule(erro['PP'] & delta_erro['MP'], p_crac['MA']),
-
-    # --- LINHA ERRO 'MP' (Muito Quente) -> Resfriamento Máximo (MA) ---
-    ctrl.Rule(erro['MP'] & delta_erro['MN'], p_crac['M']),
-    ctrl.Rule(erro['MP'] & delta_erro['PN'], p_crac['A']),
-    ctrl.Rule(erro['MP'] & delta_erro['ZE'], p_crac['MA']),
-    ctrl.Rule(erro['MP'] & delta_erro['PP'], p_crac['MA']),
-    ctrl.Rule(erro['MP'] & delta_erro['MP'], p_crac['MA']),
-]
-
-crac_ctrl = ctrl.ControlSystem(rules)
-crac_sim = ctrl.ControlSystemSimulation(crac_ctrl)
+# Sistema ativo. É sempre substituído por inteiro (atribuição atômica), então
+# quem lê `sistema` uma vez por passo/comando nunca vê uma versão pela metade.
+sistema = compilar_sistema(DEFINICAO_PADRAO, 1)
+versoes_anteriores = []
+ultima_versao = 1
+recompilacao_lock = threading.Lock()
 
 def exibir_regras_fuzzy():
     """Exibe as regras fuzzy configuradas no sistema."""
-    print("Regras Fuzzy:")
-    for rule in crac_ctrl.rules:
+    print(f"Regras Fuzzy (versão {sistema['versao']}):")
+    for rule in sistema["crac_ctrl"].rules:
         print(rule)
 
 # Chamando a função para exibir as regras fuzzy
 exibir_regras_fuzzy()
 
+def mesclar_definicao(atual, parcial):
+    """Aplica uma definição parcial sobre a atual.
+
+    Campos omitidos mantêm o valor atual. Em cada variável, "termos" é
+    mesclado termo a termo (um termo com valor null é removido); "regras"
+    substitui a base inteira e é reordenada na ordem dos termos de "erro".
+    """
+    nova = dict(atual)
+    for nome, valor in parcial.items():
+        if nome in VARIAVEIS and isinstance(valor, dict):
+            var = {**nova[nome], **valor}
+            if isinstance(valor.get("termos"), dict):
+                termos = {**nova[nome]["termos"], **valor["termos"]}
+                var["termos"] = {t: mf for t, mf in termos.items() if mf is not None}
+            nova[nome] = var
+        else:
+            nova[nome] = valor
+
+    regras, erro = nova.get("regras"), nova.get("erro")
+    if isinstance(regras, dict) and isinstance(erro, dict) and isinstance(erro.get("termos"), dict):
+        # termos desconhecidos vão para o fim, para a validação rejeitá-los
+        ordem = [t for t in erro["termos"] if t in regras] + [t for t in regras if t not in erro["termos"]]
+        nova["regras"] = {t: regras[t] for t in ordem}
+    return nova
+
+def _rejeitar_definicao(motivo):
+    print(f"Definição fuzzy rejeitada: {motivo}")
+    client.publish(TOPIC_RES, json.dumps({
+        "tipo": "fuzzy_erro",
+        "versao": sistema["versao"],
+        "msg": f"Definição rejeitada: {motivo}"
+    }))
+
+def atualizar_sistema(dados):
+    """Compila uma nova definição e a ativa; roda fora da thread do MQTT.
+
+    A compilação acontece fora de `recompilacao_lock`, que só protege a
+    reserva do número de versão e a troca, para não atrasar um rollback.
+    """
+    global sistema, ultima_versao
+    with recompilacao_lock:
+        base = sistema
+        ultima_versao += 1
+        versao = ultima_versao
+
+    try:
+        nova = mesclar_definicao(base["definicao"], dados.get("definicao", {}))
+        novo = compilar_sistema(nova, versao)
+    except Exception as e:
+        _rejeitar_definicao(e)
+        return
+
+    with recompilacao_lock:
+        # Outra atualização ou rollback entrou durante a compilação: aplicar
+        # esta definição desfaria aquela mudança
+        if sistema is not base:
+            trocou = False
+        else:
+            versoes_anteriores.append(sistema)
+            del versoes_anteriores[:-MAX_VERSOES]
+            sistema = novo
+            trocou = True
+
+    if not trocou:
+        _rejeitar_definicao(f"o sistema mudou para a versão {sistema['versao']} durante a compilação; reenvie")
+        return
+
+    exibir_regras_fuzzy()
+    publicar_artefato()
+    client.publish(TOPIC_RES, json.dumps({
+        "tipo": "fuzzy_atualizado",
+        "versao": novo["versao"],
+        "msg": f"Sistema fuzzy atualizado para a versão {novo['versao']}."
+    }))
+
+def reverter_sistema(dados):
+    """Volta para a versão anterior (ou para `versao`, se informada)."""
+    global sistema
+    with recompilacao_lock:
+        alvo = dados.get("versao")
+        versoes = [s["versao"] for s in versoes_anteriores]
+        if not versoes or (alvo is not None and alvo not in versoes):
+            client.publish(TOPIC_RES, json.dumps({
+                "tipo": "fuzzy_erro",
+                "versao": sistema["versao"],
+                "msg": f"Versão indisponível para rollback: {alvo}"
+            }))
+            return
+
+        anterior = versoes_anteriores.pop()
+        while alvo is not None and anterior["versao"] != alvo:
+            anterior = versoes_anteriores.pop()
+        sistema = anterior
+
+    exibir_regras_fuzzy()
+    publicar_artefato()
+    client.publish(TOPIC_RES, json.dumps({
+        "tipo": "fuzzy_atualizado",
+        "versao": anterior["versao"],
+        "msg": f"Sistema fuzzy revertido para a versão {anterior['versao']}."
+    }))
+
 def modelo_fisico(T_atual, P_crac, Q_est, T_ext):
     return (0.9 * T_atual) - (0.08 * P_crac) + (0.05 * Q_est) + (0.02 * T_ext) + 3.5
 
+class SessaoPerfil:
+    """Sessão de profiling dos próximos `comandos` comandos ou `segundos` segundos.
+
+    Modo "deterministico" usa cProfile em cada comando medido; "amostragem"
+    lê periodicamente a pilha das threads que executam comandos medidos.
+    Comandos já em andamento quando o limite é atingido são medidos até o fim.
+    """
+
+    def __init__(self, modo, comandos=None, segundos=None, top=PERFIL_TOP):
+        self.modo = modo
+        self.restantes = comandos
+        self.fim = time.time() + segundos if segundos is not None else None
+        self.top = top
+        self.inicio = time.time()
+        self.lock = threading.Lock()
+        self.em_execucao = 0
+        self.medidos = 0
+        self.encerrada = False
+        self.stats = None                 # deterministico: pstats acumulado
+        self.threads = set()              # amostragem: threads medidas
+        self.amostras = 0
+        self.proprias = Counter()         # função no topo da pilha
+        self.acumuladas = Counter()       # função em qualquer ponto da pilha
+        self.amostrador = None
+
+        if self.modo == "amostragem":
+            self.amostrador = threading.Thread(target=self._amostrar, daemon=True)
+            self.amostrador.start()
+        if self.fim is not None:
+            timer = threading.Timer(segundos, self._talvez_encerrar)
+            timer.daemon = True
+            timer.start()
+        self._talvez_encerrar()
+
+    def _limite_atingido(self):
+        return (self.restantes is not None and self.restantes <= 0) or \
+               (self.fim is not None and time.time() >= self.fim)
+
+    def aceitar(self):
+        """Reserva a medição de um comando; False se a sessão não aceita mais."""
+        with self.lock:
+            if self.encerrada or self._limite_atingido():
+                return False
+            if self.restantes is not None:
+                self.restantes -= 1
+            self.em_execucao += 1
+            return True
+
+    def executar(self, func, dados):
+        if self.modo == "deterministico":
+            prof = cProfile.Profile()
+            try:
+                prof.enable()
+            except ValueError:
+                # A partir do Python 3.12 só um cProfile pode estar ativo por
+                # vez; o comando roda sem medição em vez de ser perdido
+                self._terminar_comando(medido=False)
+                return func(dados)
+            try:
+                return func(dados)
+            finally:
+                prof.disable()
+                with self.lock:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(prof)
+                    else:
+                        self.stats.add(prof)
+                self._terminar_comando()
+
+        ident = threading.get_ident()
+        with self.lock:
+            self.threads.add(ident)
+        try:
+            return func(dados)
+        finally:
+            with self.lock:
+                self.threads.discard(ident)
+            self._terminar_comando()
+
+    def _terminar_comando(self, medido=True):
+        with self.lock:
+            self.em_execucao -= 1
+            if medido:
+                self.medidos += 1
+        self._talvez_encerrar()
+
+    def _amostrar(self):
+        proprio = threading.get_ident()
+        while not self.encerrada:
+            frames = sys._current_frames()
+            with self.lock:
+                idents = [i for i in self.threads if i != proprio]
+            for ident in idents:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                topo = self._nome_funcao(frame.f_code)
+                vistas = set()
+                while frame is not None:
+                    vistas.add(self._nome_funcao(frame.f_code))
+                    frame = frame.f_back
+                with self.lock:
+                    self.amostras += 1
+                    self.proprias[topo] += 1
+                    self.acumuladas.update(vistas)
+            time.sleep(PERFIL_INTERVALO_AMOSTRA)
+
+    @staticmethod
+    def _nome_funcao(code):
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _talvez_encerrar(self):
+        with self.lock:
+            if self.encerrada or self.em_execucao or not self._limite_atingido():
+                return
+            self.encerrada = True
+        # o amostrador sai no próximo ciclo; depois dele os contadores não mudam
+        if self.amostrador is not None and self.amostrador is not threading.current_thread():
+            self.amostrador.join()
+        encerrar_perfil(self)
+
+    def resumo(self):
+        """Grava as estatísticas em PERFIL_DIR e retorna (arquivo, top funções)."""
+        os.makedirs(PERFIL_DIR, exist_ok=True)
+        nome = os.path.join(PERFIL_DIR, f"perfil_{time.strftime('%Y%m%d_%H%M%S')}_{self.modo}")
+
+        if self.modo == "deterministico":
+            arquivo = nome + ".prof"
+            self.stats.dump_stats(arquivo)
+            linhas = sorted(self.stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+            top = [{
+                "funcao": f"{func} ({os.path.basename(arq)}:{linha})",
+                "chamadas": nc,
+                "tempo_proprio_s": round(tt, 6),
+                "tempo_acumulado_s": round(ct, 6)
+            } for (arq, linha, func), (cc, nc, tt, ct, callers) in linhas[:self.top]]
+            return arquivo, top
+
+        arquivo = nome + ".json"
+        total = max(self.amostras, 1)
+        with open(arquivo, "w") as f:
+            json.dump({
+                "intervalo_s": PERFIL_INTERVALO_AMOSTRA,
+                "amostras": self.amostras,
+                "proprias": dict(self.proprias.most_common()),
+                "acumuladas": dict(self.acumuladas.most_common())
+            }, f, indent=2)
+        top = [{
+            "funcao": funcao,
+            "amostras": n,
+            "proprio_pct": round(100 * n / total, 2),
+            "acumulado_pct": round(100 * self.acumuladas[funcao] / total, 2)
+        } for funcao, n in self.proprias.most_common(self.top)]
+        return arquivo, top
+
+perfil = None  # sessão de profiling ativa
+
+def iniciar_perfil(dados):
+    global perfil
+    modo = dados.get("modo", "deterministico")
+    comandos = dados.get("comandos")
+    segundos = dados.get("segundos")
+    erro_msg = None
+
+    try:
+        comandos = int(comandos) if comandos is not None else None
+        segundos = float(segundos) if segundos is not None else None
+        top = int(dados.get("top", PERFIL_TOP))
+    except (TypeError, ValueError):
+        erro_msg = "'comandos', 'segundos' e 'top' devem ser números."
+    else:
+        if modo not in ("deterministico", "amostragem"):
+            erro_msg = f"Modo de profiling desconhecido: {modo}"
+        elif (comandos is not None and comandos <= 0) or (segundos is not None and segundos <= 0) \
+                or top <= 0:
+            erro_msg = "'comandos', 'segundos' e 'top' devem ser positivos."
+        elif perfil is not None and not perfil.encerrada:
+            erro_msg = "Já existe uma sessão de profiling ativa."
+
+    if erro_msg:
+        client.publish(TOPIC_RES, json.dumps({"tipo": "perfil_erro", "msg": erro_msg}))
+        return
+
+    if comandos is None and segundos is None:
+        comandos = 1
+    perfil = SessaoPerfil(modo, comandos=comandos, segundos=segundos, top=top)
+    print(f"Profiling {modo} ativado (comandos={comandos}, segundos={segundos})")
+
+def encerrar_perfil(sessao):
+    if sessao.medidos == 0:
+        arquivo, top = None, []
+        msg = "Profiling encerrado sem comandos medidos."
+    else:
+        arquivo, top = sessao.resumo()
+        msg = f"Profiling de {sessao.medidos} comando(s) salvo em {arquivo}"
+    print(msg)
+
+    client.publish(TOPIC_RES, json.dumps({
+        "tipo": "perfil",
+        "modo": sessao.modo,
+        "comandos_medidos": sessao.medidos,
+        "duracao_s": round(time.time() - sessao.inicio, 3),
+        "arquivo": arquivo,
+        "top": top,
+        "msg": msg
+    }))
+
+def executar_comando(func, dados):
+    """Executa o comando, medindo-o se houver uma sessão de profiling ativa."""
+    sessao = perfil
+    if sessao is None or not sessao.aceitar():
+        return func(dados)
+    return sessao.executar(func, dados)
+
 def on_connect(client, userdata, flags, rc):
     print(f"Conectado ao Broker (RC: {rc})")
     client.subscribe(TOPIC_CMD)
+    publicar_artefato()
 
 def on_message(client, userdata, msg):
     try:
         payload = json.loads(msg.payload.decode())
         cmd = payload.get("cmd")
         if cmd == "controle_pontual":
-            tratar_pontual(payload)
+            executar_comando(tratar_pontual, payload)
+        elif cmd == "controle_lote":
+            executar_comando(tratar_lote, payload)
         elif cmd == "simular_24h":
-            t = threading.Thread(target=tratar_simulacao, args=(payload,))
+            t = threading.Thread(target=executar_comando, args=(tratar_simulacao, payload))
             t.start()
+        elif cmd == "parar_simulacao":
+            parar_simulacao()
+        elif cmd == "atualizar_fuzzy":
+            t = threading.Thread(target=executar_comando, args=(atualizar_sistema, payload))
+            t.start()
+        elif cmd == "reverter_fuzzy":
+            executar_comando(reverter_sistema, payload)
+        elif cmd == "perfilar":
+            iniciar_perfil(payload)
     except Exception as e:
         print(f"Erro msg: {e}")
 
-def tratar_pontual(dados):
-    try:
-        # --- Entrada bruta do frontend ---
-        e_raw = float(dados.get("erro", 0))
-        de_raw = float(dados.get("delta_erro", 0))
-
-        # --- Saturação para o universo fuzzy ---
-        e = max(-12, min(12, e_raw))
-        de = max(-2, min(2, de_raw))
-
-        # --- Atribui valores ao simulador ---
-        crac_sim.input['erro'] = e
-        crac_sim.input['delta_erro'] = de
-
-        # --- Processa o fuzzy ---
-        try:
-            crac_sim.compute()
-            print(f"Potência calculada: {crac_sim.output['p_crac']}")
-        except Exception as err:
-            print("Erro no cálculo fuzzy:", err)
-
-        # --- Saída do fuzzy ---
-        res = crac_sim.output.get('p_crac', 50.0)
-
-        # >>> NOVO: graus de pertinência para depuração
-        mu = {
-            "erro": {
-                termo: float(fuzz.interp_membership(erro.universe, erro[termo].mf, e))
-                for termo in erro.terms
-            },
-            "delta_erro": {
-                termo: float(fuzz.interp_membership(delta_erro.universe, delta_erro[termo].mf, de))
-                for termo in delta_erro.terms
-            }
-        }
-
-        # --- Publica o resultado do cálculo pontual ---
-        client.publish(TOPIC_RES, json.dumps({
-            "tipo": "pontual",
-            "erro": float(e),
-            "delta_erro": float(de),
-            "p_crac": float(res),
-            "msg": f"Cálculo Fuzzy: erro={de:.2f} -> potência={res:.2f}"
-        }))
-
-    except Exception as e:
-        print(f"Erro ao tratar controle pontual: {e}")
-
 def tratar_pontual(dados):
     try:
         e = float(dados.get("erro", 0))
         de = float(dados.get("delta_erro", 0))
+        explicar = bool(dados.get("explicar", False))
 
-        # 1. Cálculo normal do fuzzy
-        crac_sim.input['erro'] = e
-        crac_sim.input['delta_erro'] = de
-
-        crac_sim.compute()
-        print(f"Potência calculada: {crac_sim.output['p_crac']}")
-        res = crac_sim.output.get('p_crac', 50.0)
-
-        # 2. Calcular pertinências individuais (MU) das entradas
-        erro_mus = {term: fuzz.interp_membership(erro.universe, erro[term].mf, e)
-                    for term in erro.terms}
-
-        delta_mus = {term: fuzz.interp_membership(delta_erro.universe, delta_erro[term].mf, de)
-                     for term in delta_erro.terms}
-
-        # 3. Calcular ativação de cada regra MISO (min())
-        rules_activation = []
-
-        for idx, rule in enumerate(rules):
-            # Verifica quais termos a regra usa
-            termo_erro = rule.antecedent.term1
-            termo_delta = rule.antecedent.term2
-
-            mu_e = erro_mus[termo_erro]
-            mu_de = delta_mus[termo_delta]
-            mu_rule = min(mu_e, mu_de)
+        # entradas fora do universo são saturadas dentro de inferir()
+        sis = sistema
+        res = inferir(sis, e, de, explicar=explicar)
+        p = res["p_crac"]
+        print(f"Potência calculada: {p}")
 
-            rules_activation.append({
-                "rule_id": idx + 1,
-                "erro": termo_erro,
-                "delta": termo_delta,
-                "activ": round(mu_rule, 4),
-                "saida": rule.consequent.term
-            })
-
-        # 4. Envio MQTT incluindo as ativações das regras
         client.publish(TOPIC_RES, json.dumps({
             "tipo": "pontual",
             "erro": e,
             "delta_erro": de,
-            "p_crac": res,
-            "saida": res,   # <-- ESSENCIAL PARA O GRÁFICO DE SAÍDA
-            "msg": f"Cálculo Fuzzy: erro={e:.2f}, delta_erro={de:.2f} → potência={res:.1f}%"
+            "saida": p,   # <-- ESSENCIAL PARA O GRÁFICO DE SAÍDA
+            "versao": sis["versao"],
+            **res,
+            "msg": f"Cálculo Fuzzy: erro={e:.2f}, delta_erro={de:.2f} → potência={p:.1f}%"
         }))
 
-
     except Exception as e:
         print(f"Erro pontual: {e}")
 
-def calcular_agregacao(ativacoes):
-    agregado = np.zeros_like(p_crac.universe)
+def _eixos_grade(grade):
+    """Eixos (erro, delta_erro) da grade; o tamanho é validado antes de alocar."""
+    specs = []
+    for nome in ("erro", "delta_erro"):
+        inicio, fim, n = grade[nome]
+        n = int(n)
+        if not 1 <= n <= MAX_LOTE:
+            raise ValueError(f"Grade de '{nome}' deve ter entre 1 e {MAX_LOTE} pontos")
+        specs.append((float(inicio), float(fim), n))
+
+    total = specs[0][2] * specs[1][2]
+    if total > MAX_LOTE:
+        raise ValueError(f"Lote com {total} pontos excede o limite de {MAX_LOTE}")
+    return [np.linspace(*spec) for spec in specs]
+
+def _entrada_lote(dados, nome):
+    x = np.atleast_1d(np.asarray(dados.get(nome, 0), dtype=float))
+    if x.ndim != 1:
+        raise ValueError("'erro' e 'delta_erro' devem ser listas de números")
+    if not 1 <= x.size <= MAX_LOTE:
+        raise ValueError(f"'{nome}' deve ter entre 1 e {MAX_LOTE} valores")
+    return x
+
+def tratar_lote(dados):
+    """Avalia vários pares (erro, delta_erro) em uma única resposta.
+
+    Aceita listas em "erro"/"delta_erro" (um escalar é repetido) ou uma grade
+    {"grade": {"erro": [ini, fim, n], "delta_erro": [ini, fim, n]}}, que
+    devolve a superfície p_crac[i][j] para erro[i] e delta_erro[j].
+    """
+    try:
+        sis = sistema
+        grade = dados.get("grade")
+        if grade is not None:
+            eixo_e, eixo_de = _eixos_grade(grade)
+            e, de = np.meshgrid(eixo_e, eixo_de, indexing="ij")
+            forma = e.shape
+        else:
+            e, de = np.broadcast_arrays(_entrada_lote(dados, "erro"),
+                                        _entrada_lote(dados, "delta_erro"))
+            eixo_e, eixo_de, forma = e, de, e.shape
+
+        p = inferir_lote(sis, e, de)
+        resposta = {
+            "tipo": "lote",
+            "versao": sis["versao"],
+            "n": int(e.size),
+            "erro": eixo_e.round(4).tolist(),
+            "delta_erro": eixo_de.round(4).tolist(),
+            "p_crac": p.reshape(forma).round(4).tolist(),
+        }
 
-    for ativ in ativacoes:
-        termo = ativ["saida"]
-        grau = ativ["ativacao"]
+        # pertinências por valor de cada eixo (na grade, sem repetir por ponto)
+        if dados.get("pertinencias"):
+            tab = sis["tabelas"]
+            resposta["pertinencias"] = {
+                nome: dict(zip(tab[nome]["termos"], _pertinencias(tab[nome], eixo).T.round(4).tolist()))
+                for nome, eixo in (("erro", eixo_e), ("delta_erro", eixo_de))
+            }
 
-        # função de pertinência do termo da saída
-        mf = fuzz.interp_membership(
-            p_crac.universe, 
-            p_crac[termo].mf, 
-            p_crac.universe
-        )
+        resposta["msg"] = f"Lote fuzzy: {e.size} pontos avaliados"
+        client.publish(TOPIC_RES, json.dumps(resposta))
 
-        # max(combinação anterior, min(grau da regra, MF do termo))
-        agregado = np.maximum(agregado, np.minimum(grau, mf))
+    except Exception as e:
+        print(f"Erro lote: {e}")
+        client.publish(TOPIC_RES, json.dumps({"tipo": "lote_erro", "msg": f"Lote rejeitado: {e}"}))
+
+class EstatisticaCorrente:
+    """Mínimo, máximo e média de uma série, atualizados em O(1) de memória."""
+
+    def __init__(self):
+        self.n = 0
+        self.soma = 0.0
+        self.min = None
+        self.max = None
+
+    def atualizar(self, valor):
+        self.n += 1
+        self.soma += valor
+        self.min = valor if self.min is None else min(self.min, valor)
+        self.max = valor if self.max is None else max(self.max, valor)
+
+    def resumo(self):
+        avg = self.soma / self.n if self.n else None
+        return {"min": self.min, "max": self.max, "avg": avg}
+
+class AgregadosSimulacao:
+    """Agregados correntes da simulação (temp, crac, erro, energia e violações)."""
+
+    def __init__(self):
+        self.temp = EstatisticaCorrente()
+        self.crac = EstatisticaCorrente()
+        self.erro = EstatisticaCorrente()
+        self.energia_kwh = 0.0
+        self.violacoes = 0
+        self.passos = 0
+
+    def atualizar(self, passo):
+        self.temp.atualizar(passo["temp"])
+        self.crac.atualizar(passo["crac"])
+        self.erro.atualizar(passo["erro"])
+        self.energia_kwh += passo["crac"] / 60  # 1 passo = 1 minuto
+        if passo["temp"] < LIM_INF or passo["temp"] > LIM_SUP:
+            self.violacoes += 1
+        self.passos += 1
+
+    def resumo(self):
+        return {
+            "temp": self.temp.resumo(),
+            "crac": self.crac.resumo(),
+            "erro": self.erro.resumo(),
+            "energia_kwh": self.energia_kwh,
+            "violacoes": self.violacoes,
+            "passos": self.passos
+        }
 
-    return agregado
+class JanelaKPI:
+    """KPIs de controle sobre uma janela de passos, atualizados em O(1) por passo.
+
+    "deslizante" cobre os últimos `tamanho` passos, "fixa" recomeça a cada
+    `tamanho` passos e "acumulada" cobre toda a simulação.
+    """
+
+    def __init__(self, tipo, tamanho=None):
+        self.tipo = tipo
+        self.tamanho = tamanho
+        self.amostras = deque()  # só usada pela janela deslizante
+        self.picos = deque()     # máximos candidatos de sobressinal (deslizante)
+        self.ultimo_fora = None  # último passo fora da banda de acomodação
+        self._zerar()
+
+    def _zerar(self):
+        self.n = 0
+        self.inicio = None
+        self.soma_erro2 = 0.0
+        self.em_faixa = 0
+        self.soma_crac = 0.0
+        self.curso = 0.0
+        self.sobressinal = 0.0
+
+    def atualizar(self, t, erro, crac, curso):
+        if self.tipo == "fixa" and self.n == self.tamanho:
+            self._zerar()
+        if self.inicio is None:
+            self.inicio = t
+
+        amostra = (t, erro * erro, abs(erro) <= BANDA_FAIXA, crac, curso)
+        self._somar(amostra, 1)
+        if abs(erro) > BANDA_ACOMODACAO:
+            self.ultimo_fora = t
+
+        pico = max(erro, 0.0)
+        if self.tipo == "deslizante":
+            self.amostras.append(amostra)
+            if self.n > self.tamanho:
+                self._somar(self.amostras.popleft(), -1)
+                self.inicio = self.amostras[0][0]
+            # fila monotônica: o primeiro elemento é o máximo da janela
+            while self.picos and self.picos[-1][1] <= pico:
+                self.picos.pop()
+            self.picos.append((t, pico))
+            if self.picos[0][0] < self.inicio:
+                self.picos.popleft()
+            self.sobressinal = self.picos[0][1]
+        else:
+            self.sobressinal = max(self.sobressinal, pico)
+
+    def _somar(self, amostra, sinal):
+        _, erro2, dentro, crac, curso = amostra
+        self.n += sinal
+        self.soma_erro2 += sinal * erro2
+        self.em_faixa += sinal * dentro
+        self.soma_crac += sinal * crac
+        self.curso += sinal * curso
+
+    def resumo(self):
+        if not self.n:
+            return None
+        acomodacao = 0
+        if self.ultimo_fora is not None and self.ultimo_fora >= self.inicio:
+            acomodacao = self.ultimo_fora - self.inicio + 1
+        return {
+            "inicio": self.inicio,
+            "passos": self.n,
+            "rmse": round(math.sqrt(max(self.soma_erro2, 0.0) / self.n), 4),
+            "tempo_em_faixa_pct": round(100 * self.em_faixa / self.n, 2),
+            "energia_kwh": round(self.soma_crac / 60, 3),  # 1 passo = 1 minuto
+            "sobressinal": round(self.sobressinal, 3),
+            "tempo_acomodacao_min": acomodacao,
+            "curso_atuador": round(self.curso, 2)
+        }
 
-def calcular_defuzzificacao(agregado):
-    return fuzz.defuzz(p_crac.universe, agregado, 'centroid')
+class MotorKPI:
+    """Atualiza todas as janelas de JANELAS_KPI a cada passo da simulação."""
 
-def tratar_simulacao(dados):
-    global simulating
-    if simulating: return
-    simulating = True
-    print("A iniciar Simulação...")
+    def __init__(self):
+        self.janelas = {nome: JanelaKPI(tipo, tamanho) for nome, tipo, tamanho in JANELAS_KPI}
+        self.crac_ant = None
+
+    def atualizar(self, passo):
+        curso = 0.0 if self.crac_ant is None else abs(passo["crac"] - self.crac_ant)
+        self.crac_ant = passo["crac"]
+        for janela in self.janelas.values():
+            janela.atualizar(passo["t"], passo["erro"], passo["crac"], curso)
 
-    # T_set = 22.0
-    # T_atual = 22.0
-    # erro_ant = 0
-    # T_ext_base = float(dados.get("temp_ext", 25))
-    # Q_base = float(dados.get("carga", 40))
+    def resumo(self):
+        return {nome: janela.resumo() for nome, janela in self.janelas.items()}
 
+def simular_passos(dados, horizonte=PASSOS_DIA, tam_bloco=60, explicar=False):
+    """Gera a simulação em blocos de `tam_bloco` passos (1 passo = 1 minuto).
+
+    `horizonte` é o número de minutos a simular (None = indefinidamente).
+    Cada item gerado é `(bloco, agregados)`: a lista de passos do bloco e os
+    agregados correntes. Apenas o bloco atual fica em memória, então o
+    consumidor pode parar, gravar ou publicar os blocos à medida que chegam.
+    Com `explicar=True` cada passo traz também a explicação da inferência.
+    """
     # ler setpoint enviado pelo frontend, padrão 22 °C
     T_set = float(dados.get("setpoint", 22.0))
 
@@ -256,131 +1000,169 @@ def tratar_simulacao(dados):
     T_ext_base = float(dados.get("temp_ext", 25))
     Q_base = float(dados.get("carga", 40))
 
-    hist_temp = []
-    hist_crac = []
-    hist_erro = []
+    agregados = AgregadosSimulacao()
+    bloco = []
+    t = 0
+
+    while horizonte is None or t < horizonte:
+        # perfis diários se repetem a cada 24 h
+        minuto_dia = t % PASSOS_DIA
+        T_ext = T_ext_base + 5 * math.sin(2 * math.pi * (minuto_dia - 480)/PASSOS_DIA) + np.random.normal(0, 0.1)
+        Q_est = Q_base + 15 * math.exp(-((minuto_dia - 720)**2)/(300**2)) + np.random.normal(0, 0.5)
 
-    for t in range(1440): 
-        if not simulating: break
-        
-        T_ext = T_ext_base + 5 * math.sin(2 * math.pi * (t - 480)/1440) + np.random.normal(0, 0.1)
-        Q_est = Q_base + 15 * math.exp(-((t - 720)**2)/(300**2)) + np.random.normal(0, 0.5)
-        
         erro_atual = T_atual - T_set
         delta_e = erro_atual - erro_ant
-       #print(f"Delta Erro: {delta_e}")
-        
-        crac_sim.input['erro'] = max(-14, min(14, erro_atual))
-        crac_sim.input['delta_erro'] = max(-6, min(6, delta_e))
-        
-        try: crac_sim.compute()
-        except: pass
-        P_crac = crac_sim.output.get('p_crac', 50.0)
-        
-        T_prox = modelo_fisico(T_atual, P_crac, Q_est, T_ext)
-        
-        hist_temp.append(T_atual)
-        hist_crac.append(P_crac)
-        hist_erro.append(erro_atual)
-
-        # limites operacionais para alerta
-        LIM_INF = 18
-        LIM_SUP = 26
-
-        if T_atual < LIM_INF or T_atual > LIM_SUP:
-            # envia alerta
-            client.publish(TOPIC_ALERT, json.dumps({
-                "msg": f"ALERTA: Temp {T_atual:.1f}°C (Min {t})",
-                "tipo": "alerta"
-            }))
-        else:
-            # envia estado normal
-            client.publish(TOPIC_ALERT, json.dumps({
-                "msg": "Sistema Normal",
-                "tipo": "normal"
-            }))
 
+        # o sistema é lido uma vez por passo: trocas entram no próximo passo
+        sis = sistema
+        res = inferir(sis, erro_atual, delta_e, explicar=explicar)
+        P_crac = res["p_crac"]
 
-        if t % 5 == 0:
-            client.publish(TOPIC_STREAM, json.dumps({
-                "t": t, "temp": round(T_atual, 2), "crac": round(P_crac, 1)
-            }))
-            time.sleep(0.005)
+        T_prox = modelo_fisico(T_atual, P_crac, Q_est, T_ext)
+
+        passo = {
+            "t": t, "temp": T_atual, "crac": P_crac,
+            "erro": erro_atual, "delta_erro": delta_e,
+            "T_ext": T_ext, "Q_est": Q_est, "temp_prox": T_prox,
+            "versao": sis["versao"]
+        }
+        if explicar:
+            passo["explicacao"] = res
+        agregados.atualizar(passo)
+        bloco.append(passo)
 
         erro_ant = erro_atual
         T_atual = T_prox
+        t += 1
 
-        timestamp = t  # minuto da simulação
-
-        # 1. ENTRADAS DO FUZZY
-        print("\nSIMULACAO")
-        print(f"[{timestamp} min] Entradas do Fuzzy:", flush=True)
-        print(f"  erro       = {erro_atual:.3f}", flush=True)
-        print(f"  delta_erro = {delta_e:.3f}", flush=True)
+        if len(bloco) == tam_bloco:
+            yield bloco, agregados
+            bloco = []
 
-        # 2. SAÍDA DO FUZZY
-        print(f"  saida (p_crac) = {P_crac:.2f} %", flush=True)
+    if bloco:
+        yield bloco, agregados
 
-        # 3. TEMPERATURA ATUAL
-        print(f"  T_atual   = {T_atual:.3f} °C")
+def publicar_passo(passo):
+    t = passo["t"]
+    T_atual = passo["temp"]
 
-        print(f"  (T_atual={T_atual:.2f},  P_crac={P_crac:.2f},  Q_est={Q_est:.2f},  T_ext={T_ext:.2f})")
-
-        # calcular pertinências das entradas
-        mu_erro = {term: fuzz.interp_membership(erro.universe, erro[term].mf, erro_atual)
-                   for term in erro.terms}
-        mu_delta = {term: fuzz.interp_membership(delta_erro.universe, delta_erro[term].mf, delta_e)
-                    for term in delta_erro.terms}
+    if T_atual < LIM_INF or T_atual > LIM_SUP:
+        # envia alerta
+        client.publish(TOPIC_ALERT, json.dumps({
+            "msg": f"ALERTA: Temp {T_atual:.1f}°C (Min {t})",
+            "tipo": "alerta"
+        }))
+    else:
+        # envia estado normal
+        client.publish(TOPIC_ALERT, json.dumps({
+            "msg": "Sistema Normal",
+            "tipo": "normal"
+        }))
 
-        rules_activation = []
+    if t % 5 == 0:
+        client.publish(TOPIC_STREAM, json.dumps({
+            "t": t, "temp": round(T_atual, 2), "crac": round(passo["crac"], 1),
+            "versao": passo["versao"]
+        }))
+        time.sleep(0.005)
 
-        for idx, rule in enumerate(rules):
+def publicar_kpi(passo, kpi):
+    client.publish(TOPIC_KPI, json.dumps({
+        "t": passo["t"],
+        "versao": passo["versao"],
+        "janelas": kpi.resumo()
+    }))
 
-            termo_erro = rule.antecedent.term1.label
-            termo_delta = rule.antecedent.term2.label
+def imprimir_passo(passo):
+    timestamp = passo["t"]  # minuto da simulação
+    erro_atual = passo["erro"]
+    delta_e = passo["delta_erro"]
+    P_crac = passo["crac"]
+    T_atual = passo["temp_prox"]
+
+    # 1. ENTRADAS DO FUZZY
+    print("\nSIMULACAO")
+    print(f"[{timestamp} min] Entradas do Fuzzy:", flush=True)
+    print(f"  erro       = {erro_atual:.3f}", flush=True)
+    print(f"  delta_erro = {delta_e:.3f}", flush=True)
+
+    # 2. SAÍDA DO FUZZY
+    print(f"  saida (p_crac) = {P_crac:.2f} %", flush=True)
+
+    # 3. TEMPERATURA ATUAL
+    print(f"  T_atual   = {T_atual:.3f} °C")
+
+    print(f"  (T_atual={T_atual:.2f},  P_crac={P_crac:.2f},  Q_est={passo['Q_est']:.2f},  T_ext={passo['T_ext']:.2f})")
+
+    res = passo.get("explicacao")
+    if res is None:
+        return
+
+    print("\nAtivacao das Regras:", flush=True)
+    for r in res["rules"]:
+        print(f" Regra {r['rule_id']:02d}: "
+            f"E={r['erro']}  DE={r['delta']}  "
+            f"Ativacao={r['activ']} - Saida={r['saida']}",
+            flush=True)
+
+    agregado = res["agregado"]
+    print("\n  Processo de Defuzzificacao", flush=True)
+    print(f"   Universo de saida (0 ate 100): {len(agregado)} pontos", flush=True)
+    print(f"   Agregacao (primeiros 15 pts): {np.array(agregado[:15])}", flush=True)
+    print(f"   Valor defuzzificado (centroide) - {P_crac:.3f} %", flush=True)
+
+def _rejeitar_simulacao(motivo):
+    print(f"Simulação rejeitada: {motivo}")
+    client.publish(TOPIC_RES, json.dumps({"tipo": "simulacao_erro", "msg": f"Simulação rejeitada: {motivo}"}))
+
+def parar_simulacao():
+    """Interrompe a simulação em andamento ao fim do bloco atual."""
+    global parada_solicitada
+    if simulating:
+        parada_solicitada = True
+        print("Parada da simulação solicitada.")
 
-            mu_e = mu_erro[termo_erro]
-            mu_de = mu_delta[termo_delta]
+def tratar_simulacao(dados):
+    global simulating, parada_solicitada
+    if simulating: return
 
-            mu_rule = min(mu_e, mu_de)
+    try:
+        horizonte = int(dados.get("horizonte_min", PASSOS_DIA))
+    except (TypeError, ValueError):
+        _rejeitar_simulacao(f"horizonte inválido: {dados.get('horizonte_min')!r}")
+        return
+    if not 1 <= horizonte <= MAX_HORIZONTE:
+        _rejeitar_simulacao(f"'horizonte_min' deve estar entre 1 e {MAX_HORIZONTE}, recebido {horizonte}")
+        return
 
-            saida_label = rule.consequent[0].term.label
+    simulating = True
+    parada_solicitada = False
+    print("A iniciar Simulação...")
 
-            rules_activation.append({
-                "rule_id": idx + 1,
-                "erro": termo_erro,
-                "delta_erro": termo_delta,
-                "ativacao": round(mu_rule, 4),
-                "saida": saida_label
-            })
+    agregados = AgregadosSimulacao()
+    kpi = MotorKPI()
+    passo = None
 
-        print("\nAtivacao das Regras:", flush=True)
-        for r in rules_activation:
-            print(f" Regra {r['rule_id']:02d}: "
-                f"E={r['erro']}  DE={r['delta_erro']}  "
-                f"Ativacao={r['ativacao']} - Saida={r['saida']}",
-                flush=True)
-            
-        agregado = calcular_agregacao(rules_activation)
-        saida_defuzz = calcular_defuzzificacao(agregado)
-
-        print("\n  Processo de Defuzzificacao", flush=True)
-        print(f"   Universo de saida (0 ate 100): {len(p_crac.universe)} pontos", flush=True)
-        print(f"   Agregacao (primeiros 15 pts): {agregado[:15]}", flush=True)
-        print(f"   Valor defuzzificado (centroide) - {saida_defuzz:.3f} %", flush=True)
-
-    simulating = False
-    
-    stats = {
-        "temp": {"min": min(hist_temp), "max": max(hist_temp), "avg": sum(hist_temp)/len(hist_temp)},
-        "crac": {"min": min(hist_crac), "max": max(hist_crac), "avg": sum(hist_crac)/len(hist_crac)},
-        "erro": {"min": min(hist_erro), "max": max(hist_erro), "avg": sum(hist_erro)/len(hist_erro)}
-    }
+    try:
+        for bloco, agregados in simular_passos(dados, horizonte, explicar=True):
+            for passo in bloco:
+                kpi.atualizar(passo)
+                publicar_passo(passo)
+                if (passo["t"] + 1) % KPI_INTERVALO == 0:
+                    publicar_kpi(passo, kpi)
+                imprimir_passo(passo)
+            if parada_solicitada: break
+
+        if passo is not None and (passo["t"] + 1) % KPI_INTERVALO != 0:
+            publicar_kpi(passo, kpi)
+    finally:
+        simulating = False
 
     client.publish(TOPIC_RES, json.dumps({
         "tipo": "fim_simulacao", 
-        "msg": "Simulação Finalizada.",
-        "stats": stats
+        "msg": "Simulação Interrompida." if parada_solicitada else "Simulação Finalizada.",
+        "interrompida": parada_solicitada,
+        "stats": agregados.resumo()
     }))
     print("Simulação concluída.")
 
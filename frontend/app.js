@@ -12,6 +12,8 @@ const dom = {
 
 let inputState = { erro: 0, delta: 0, setpoint: 22, text: 25, load: 40 };
 let logHistory = []; 
+let artifact = null;      // curvas MF e superfície pré-calculadas pelo backend
+let mfChartsKey = null;   // evita redesenhar os gráficos MF sem mudanças
 
 dom.in.erro.oninput = (e) => { inputState.erro = e.target.value; dom.disp.erro.innerText = e.target.value; };
 dom.in.delta.oninput = (e) => { inputState.delta = e.target.value; dom.disp.delta.innerText = e.target.value; };
@@ -38,9 +40,10 @@ function switchTab(view) {
         "flex-1 py-3 text-sm font-bold border-b-2 border-green-500 " +
         "text-green-400 bg-slate-800/50 cursor-pointer text-center";
     
-    // Se trocar para a aba Fuzzy, gerar gráficos
+    // Se trocar para a aba Fuzzy, gerar gráficos (delay evita canvas não montado;
+    // um único desenho, já que showMFCharts ignora chamadas sem mudanças)
     if (view === "fuzzy" && typeof showMFCharts === "function") {
-        showMFCharts();
+        setTimeout(showMFCharts, 50);
     }
 }
 
@@ -118,6 +121,19 @@ function showMFCharts() {
     const de = parseFloat(inputState.delta);
     const saida = parseFloat(dom.disp.crac.innerText) || 0;
 
+    const key = [artifact ? artifact.etag : "local", e, de, inputState.saida].join("|");
+    if (key === mfChartsKey) return;
+    mfChartsKey = key;
+
+    // Curvas vindas do backend (mesma definição usada no controle)
+    if (artifact) {
+        const mf = artifact.mfs;
+        plotMF("mf-erro", mf.erro.universo, mf.erro.termos, "Função de Pertinência – ERRO", e);
+        plotMF("mf-delta", mf.delta_erro.universo, mf.delta_erro.termos, "Função de Pertinência – ΔERRO", de);
+        plotMF("mf-saida", mf.p_crac.universo, mf.p_crac.termos, "Função de Pertinência – Potência CRAC", parseFloat(inputState.saida));
+        return;
+    }
+
     // Erro
     let x1 = [];
     for (let i = -12; i <= 12; i+=0.1) x1.push(i);
@@ -155,6 +171,28 @@ function showMFCharts() {
     }, "Função de Pertinência – Potência CRAC", parseFloat(inputState.saida));
 }
 
+// Artefato do backend: JSON comprimido com zlib e codificado em base64
+async function decodeArtifact(payload) {
+    const bytes = Uint8Array.from(atob(payload.dados), c => c.charCodeAt(0));
+    const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("deflate"));
+    return JSON.parse(await new Response(stream).text());
+}
+
+async function receiveArtifact(payload) {
+    if (artifact && artifact.etag === payload.etag) return;  // já em cache
+
+    artifact = { versao: payload.versao, etag: payload.etag, ...(await decodeArtifact(payload)) };
+    try { localStorage.setItem("fuzzyArtifact", JSON.stringify(payload)); } catch (e) { }
+
+    if (!document.getElementById("view-fuzzy").classList.contains("hidden")) showMFCharts();
+}
+
+// Reaproveita o último artefato recebido até o broker entregar o atual
+(function loadCachedArtifact() {
+    const cached = localStorage.getItem("fuzzyArtifact");
+    if (cached) receiveArtifact(JSON.parse(cached)).catch(() => localStorage.removeItem("fuzzyArtifact"));
+})();
+
 function fuzzyValueAt(mfs, x, operatingPoint) {
     let maxVal = 0;
 
@@ -182,11 +220,6 @@ function trapmf(x, a, b, c, d) {
     else return (d - x) / (d - c);
 }
 
-document.getElementById("tab-fuzzy").addEventListener("click", () => {
-    switchTab("fuzzy");
-    setTimeout(showMFCharts, 50);  // delay evita canvas não montado
-});
-
 function nearestIndex(array, value) {
     let nearest = 0;
     let minDiff = Infinity;
@@ -303,6 +336,14 @@ client.onMessageArrived = (msg) => {
         const payload = JSON.parse(msg.payloadString);
         const topic = msg.destinationName;
 
+        /* -----------------------------
+            ARTEFATO → curvas MF / superfície
+        ------------------------------ */
+        if (topic.includes("artefato")) {
+            receiveArtifact(payload).catch(e => logMQTT("Erro ao ler artefato: " + e, "red"));
+            return;
+        }
+
         /* -----------------------------
             STREAM → gráfico principal
         ------------------------------ */
@@ -338,7 +379,7 @@ client.onMessageArrived = (msg) => {
         /* ---------------------------------------
            RESULT → ponto de operação nos MF
         ---------------------------------------- */
-        if (topic.includes("result")) {
+        if (topic.includes("result") && typeof payload.p_crac === "number") {
 
             dom.disp.crac.innerText = payload.p_crac.toFixed(1);
 
@@ -391,6 +432,7 @@ function sendCmd(cmd) {
     if (cmd === 'controle_pontual') { 
         payload.erro = inputState.erro; 
         payload.delta_erro = inputState.delta; 
+        payload.explicar = true;              // ativações p/ tabela de regras
     }
     else if (cmd === 'simular_24h') { 
         limpar(); 
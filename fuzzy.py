@@ -3,6 +3,8 @@ import skfuzzy as fuzz
 from skfuzzy import control as ctrl
 import paho.mqtt.client as mqtt
 import json
+import os
+import pickle
 import time
 import threading
 from datetime import datetime, timedelta
@@ -11,6 +13,64 @@ import logging
 # Configuração de logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Amostras mantidas nos históricos durante simulações em streaming
+# (check_alerts usa apenas as 10 mais recentes)
+STREAM_HISTORY_LIMIT = 60
+
+# Formato dos arquivos de checkpoint (incrementar se o conteúdo mudar)
+CHECKPOINT_VERSION = 2
+
+
+class RunningAggregates:
+    """Métricas da simulação atualizadas passo a passo em memória constante"""
+    
+    def __init__(self, setpoint, step_hours=1/60):
+        self.setpoint = setpoint
+        self.step_hours = step_hours
+        self.steps = 0
+        self.sum_temperature = 0.0
+        self.sum_squared_error = 0.0
+        self.sum_power = 0.0
+        self.in_range = 0
+        self.critical_violations = 0
+        self.min_temperature = None
+        self.max_temperature = None
+    
+    def update(self, temperature, power):
+        """Incorpora um passo de simulação"""
+        error = temperature - self.setpoint
+        self.steps += 1
+        self.sum_temperature += temperature
+        self.sum_squared_error += error ** 2
+        self.sum_power += power
+        
+        if 20 <= temperature <= 24:
+            self.in_range += 1
+        if temperature < 18 or temperature > 26:
+            self.critical_violations += 1
+        
+        if self.min_temperature is None or temperature < self.min_temperature:
+            self.min_temperature = temperature
+        if self.max_temperature is None or temperature > self.max_temperature:
+            self.max_temperature = temperature
+    
+    def to_dict(self):
+        """Retorna as métricas no mesmo formato de calculate_metrics"""
+        if not self.steps:
+            return {}
+        
+        return {
+            "rmse": (self.sum_squared_error / self.steps) ** 0.5,
+            "time_in_range_percent": (self.in_range / self.steps) * 100,
+            "energy_consumption_kwh": self.sum_power * self.step_hours,
+            "critical_violations": self.critical_violations,
+            "avg_temperature": self.sum_temperature / self.steps,
+            "avg_power": self.sum_power / self.steps,
+            "max_temperature": self.max_temperature,
+            "min_temperature": self.min_temperature
+        }
+
+
 class DataCenterFuzzyController:
     def __init__(self):
         # Parâmetros do sistema
@@ -29,6 +89,7 @@ class DataCenterFuzzyController:
         self.temperature_history = []
         self.power_history = []
         self.alert_history = []
+        self.alert_count = 0  # total de alertas, mesmo com alert_history truncado
         
         # Inicializar sistema fuzzy
         self.setup_fuzzy_system()
@@ -239,6 +300,7 @@ class DataCenterFuzzyController:
         for alert in alerts:
             self.send_mqtt_alert(alert)
             self.alert_history.append(alert)
+        self.alert_count += len(alerts)
         
         return alerts
     
@@ -345,6 +407,118 @@ class DataCenterFuzzyController:
             "alerts": alerts
         }
     
+    def run_simulation_stream(self, total_steps=None, chunk_size=60, start_minute=0,
+                              history_limit=STREAM_HISTORY_LIMIT, step_delay=0.0,
+                              checkpoint_path=None, checkpoint_every=1, aggregates=None):
+        """Executa a simulação como gerador, em blocos, para qualquer horizonte
+
+        Gera tuplas (bloco, agregados) a cada `chunk_size` passos. `total_steps=None`
+        simula indefinidamente; o consumidor pode parar a qualquer momento. Os
+        históricos são truncados em `history_limit` amostras (None = sem limite)
+        para manter a memória constante; nesse caso calculate_metrics cobre só
+        a janela retida e as métricas da simulação inteira estão nos agregados.
+        
+        Com `checkpoint_path`, o estado é salvo a cada `checkpoint_every` blocos,
+        depois que o consumidor processou o bloco (ver resume_simulation).
+        """
+        if aggregates is None:
+            aggregates = RunningAggregates(self.setpoint)
+        chunk = []
+        chunks_done = 0
+        minute = start_minute
+        end_minute = None if total_steps is None else start_minute + total_steps
+        
+        while end_minute is None or minute < end_minute:
+            result = self.run_simulation_step(minute)
+            aggregates.update(result['temperature'], result['power'])
+            chunk.append(result)
+            
+            if history_limit is not None:
+                self._trim_history(history_limit)
+            
+            minute += 1
+            
+            if len(chunk) == chunk_size:
+                yield chunk, aggregates
+                chunk = []
+                chunks_done += 1
+                
+                if checkpoint_path and chunks_done % checkpoint_every == 0:
+                    self.save_checkpoint(checkpoint_path, minute, end_minute, aggregates)
+            
+            if step_delay:
+                time.sleep(step_delay)
+        
+        if chunk:
+            yield chunk, aggregates
+            
+            if checkpoint_path:
+                self.save_checkpoint(checkpoint_path, minute, end_minute, aggregates)
+    
+    def save_checkpoint(self, path, next_minute, end_minute=None, aggregates=None):
+        """Salva estado do controlador, RNG e históricos em disco"""
+        state = {
+            "version": CHECKPOINT_VERSION,
+            "setpoint": self.setpoint,
+            "current_temp": self.current_temp,
+            "prev_error": self.prev_error,
+            "simulation_time": self.simulation_time,
+            "next_minute": next_minute,
+            "end_minute": end_minute,
+            "temperature_history": self.temperature_history,
+            "power_history": self.power_history,
+            "alert_history": self.alert_history,
+            "alert_count": self.alert_count,
+            "rng_state": np.random.get_state(),
+            "aggregates": aggregates
+        }
+        
+        # Escrita atômica: um checkpoint interrompido nunca substitui o anterior
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    
+    def load_checkpoint(self, path):
+        """Restaura o estado salvo por save_checkpoint e retorna o dicionário lido"""
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        
+        if state.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(f"Versão de checkpoint não suportada: {state.get('version')}")
+        
+        self.setpoint = state["setpoint"]
+        self.current_temp = state["current_temp"]
+        self.prev_error = state["prev_error"]
+        self.simulation_time = state["simulation_time"]
+        self.temperature_history = state["temperature_history"]
+        self.power_history = state["power_history"]
+        self.alert_history = state["alert_history"]
+        self.alert_count = state["alert_count"]
+        np.random.set_state(state["rng_state"])
+        
+        logging.info(f"Checkpoint carregado: minuto {state['next_minute']}")
+        return state
+    
+    def resume_simulation(self, checkpoint_path, **stream_kwargs):
+        """Retoma a simulação do último checkpoint até o horizonte original"""
+        state = self.load_checkpoint(checkpoint_path)
+        
+        end_minute = state["end_minute"]
+        total_steps = None if end_minute is None else end_minute - state["next_minute"]
+        
+        return self.run_simulation_stream(total_steps,
+                                          start_minute=state["next_minute"],
+                                          checkpoint_path=checkpoint_path,
+                                          aggregates=state["aggregates"],
+                                          **stream_kwargs)
+    
+    def _trim_history(self, limit):
+        """Mantém apenas as últimas `limit` amostras dos históricos"""
+        del self.temperature_history[:-limit]
+        del self.power_history[:-limit]
+        del self.alert_history[:-limit]
+    
     def run_24h_simulation(self):
         """Executa simulação completa de 24 horas"""
         logging.info("Iniciando simulação de 24 horas...")
@@ -352,17 +526,18 @@ class DataCenterFuzzyController:
         results = []
         total_steps = 1440  # 24 horas em minutos
         
-        for minute in range(total_steps):
-            result = self.run_simulation_step(minute)
-            results.append(result)
-            
-            # Log a cada hora
-            if minute % 60 == 0:
-                hour = minute // 60
-                logging.info(f"Hora {hour:02d}:00 - Temp: {result['temperature']:.2f}°C, "
-                           f"Power: {result['power']:.1f}%")
-            
-            time.sleep(0.01)  # Pequena pausa para simulação em tempo real
+        stream = self.run_simulation_stream(total_steps, history_limit=None,
+                                            step_delay=0.01)  # Pequena pausa para simulação em tempo real
+        for chunk, _ in stream:
+            for result in chunk:
+                results.append(result)
+                
+                # Log a cada hora
+                minute = result['time']
+                if minute % 60 == 0:
+                    hour = minute // 60
+                    logging.info(f"Hora {hour:02d}:00 - Temp: {result['temperature']:.2f}°C, "
+                               f"Power: {result['power']:.1f}%")
         
         # Calcular métricas finais
         metrics = self.calculate_metrics()
@@ -371,7 +546,11 @@ class DataCenterFuzzyController:
         return results, metrics
     
     def calculate_metrics(self):
-        """Calcula métricas de avaliação do sistema"""
+        """Calcula métricas de avaliação do sistema
+
+        Usa os históricos em memória: após run_simulation_stream com
+        `history_limit`, use RunningAggregates.to_dict() para a simulação inteira.
+        """
         if not self.temperature_history:
             return {}
         
@@ -416,7 +595,7 @@ class DataCenterFuzzyController:
             "setpoint": self.setpoint,
             "simulation_time": self.simulation_time,
             "mqtt_connected": self.mqtt_connected,
-            "total_alerts": len(self.alert_history)
+            "total_alerts": self.alert_count
         }
 
 
@@ -437,7 +616,7 @@ def main():
         print(f"{key}: {value}")
     
     # Exibir resumo de alertas
-    print(f"\n=== TOTAL DE ALERTAS: {len(controller.alert_history)} ===")
+    print(f"\n=== TOTAL DE ALERTAS: {controller.alert_count} ===")
     for alert in controller.alert_history[-5:]:  # Últimos 5 alertas
         print(f"{alert['timestamp']} - {alert['type']}: {alert['message']}")
 